@@ -92,7 +92,8 @@ class VQVAELabelSmoothedCrossEntropyCriterion(FairseqCriterion):
         shifted_src_tokens, lengths, target_tokens = sample['net_input']['src_tokens'], \
                                                      sample['net_input']['src_lengths'], sample['target']
         #  logits, diff, quantize_stats, mask.sum().type_as(diff), codes, quantize_out['word_predict']
-        net_output = model(shifted_src_tokens, lengths, target_tokens, self.updates)
+        net_output = model(shifted_src_tokens, lengths, target_tokens, self.updates,
+                           conv_masks=sample.get('conv_masks', None))
         loss, nll_loss = self.compute_loss(model, net_output, sample, reduce=reduce)  # loss is the sum loss over tokens
         commit_weight = self.get_commitment_weight()
 
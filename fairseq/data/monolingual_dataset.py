@@ -9,7 +9,7 @@ import torch
 from . import data_utils, FairseqDataset
 import math
 
-def collate(samples, pad_idx, eos_idx):
+def collate(samples, pad_idx, eos_idx, conv_strides=None):
     if len(samples) == 0:
         return {}
 
@@ -33,18 +33,31 @@ def collate(samples, pad_idx, eos_idx):
     else:
         target = src_tokens
 
-    return {
+    src_lengths = torch.LongTensor([
+        s['source'].numel() for s in samples
+    ])
+    batch = {
         'id': torch.LongTensor([s['id'] for s in samples]),
         'nsentences': len(samples),
         'ntokens': sum(len(s['source']) for s in samples),
         'net_input': {
             'src_tokens': src_tokens,
-            'src_lengths': torch.LongTensor([
-                s['source'].numel() for s in samples
-            ]),
+            'src_lengths': src_lengths,
         },
         'target': target,
     }
+    if conv_strides is not None:
+        # padding masks after each strided conv of the encoder, built on the
+        # data loader workers so the model does not recompute them on the GPU
+        lengths = src_lengths.numpy()
+        max_length = src_tokens.size(1)
+        conv_masks = []
+        for stride in conv_strides:
+            lengths = (lengths - 1) // stride + 1
+            max_length = (max_length - 1) // stride + 1
+            conv_masks.append(torch.from_numpy(np.arange(max_length)[None, :] < lengths[:, None]))
+        batch['conv_masks'] = conv_masks
+    return batch
 
 
 class MonolingualDataset(FairseqDataset):
@@ -57,10 +70,12 @@ class MonolingualDataset(FairseqDataset):
         vocab (~fairseq.data.Dictionary): vocabulary
         shuffle (bool, optional): shuffle the elements before batching
             (default: True).
+        conv_strides (List[int], optional): if set, precompute the padding
+            masks of a strided conv encoder in the collater (default: None).
     """
 
     def __init__(self, dataset, sizes, src_vocab, tgt_vocab, add_eos_for_other_targets, shuffle,
-                 targets=None, add_bos_token=False):
+                 targets=None, add_bos_token=False, conv_strides=None):
         self.dataset = dataset
         self.sizes = np.array(sizes)
         self.vocab = src_vocab
@@ -68,6 +83,7 @@ class MonolingualDataset(FairseqDataset):
         self.add_eos_for_other_targets = add_eos_for_other_targets
         self.shuffle = shuffle
         self.add_bos_token = add_bos_token
+        self.conv_strides = conv_strides
 
         assert targets is None or all(t in {'self', 'future', 'past'} for t in targets), \
             "targets must be none or one of 'self', 'future', 'past'"
@@ -169,8 +185,12 @@ class MonolingualDataset(FairseqDataset):
                 - `target` (LongTensor): a padded 2D Tensor of tokens in the
                   target sentence of shape `(bsz, tgt_len)`. Padding will appear
                   on the right.
+
+                - `conv_masks` (List[BoolTensor], optional): padding masks of
+                  shape `(bsz, T_i)` after each strided conv, only present
+                  when *conv_strides* is set.
         """
-        return collate(samples, self.vocab.pad(), self.vocab.eos())
+        return collate(samples, self.vocab.pad(), self.vocab.eos(), self.conv_strides)
 
     def num_tokens(self, index):
         """Return the number of tokens in a sample. This value is used to
@@ -5,15 +5,17 @@
 
 import torch
 import numpy as np
+from torch.nn.utils.rnn import pad_sequence
 from . import FairseqDataset
 
 
 class RawLabelDataset(FairseqDataset):
 
-    def __init__(self, labels):
+    def __init__(self, labels, pad_idx=0):
         super().__init__()
         self.labels = labels
-        self.sizes = np.array([len(l) for l in labels])
+        self.sizes = np.fromiter(map(len, labels), dtype=np.int64, count=len(labels))
+        self.pad_idx = pad_idx
 
     def __getitem__(self, index):
         return self.labels[index]
@@ -22,7 +24,31 @@ class RawLabelDataset(FairseqDataset):
         return len(self.labels)
 
     def collater(self, samples):
-        return torch.tensor(samples)
+        if len(samples) == 0:
+            return torch.tensor(samples)
+        if torch.is_tensor(samples[0]):
+            if all(len(s) == len(samples[0]) for s in samples):
+                return torch.stack(samples, dim=0)
+            return pad_sequence(samples, batch_first=True, padding_value=self.pad_idx)
+        if np.ndim(samples[0]) == 0:
+            return torch.tensor(samples)
+        rows = [np.asarray(s) for s in samples]
+        if any(r.ndim != 1 for r in rows):
+            # nested labels keep the generic path
+            return torch.tensor(samples)
+        # list/ndarray samples: fill one host buffer and hand it to torch without a copy
+        lens = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows))
+        # whole rows decide the dtype, so a float anywhere in a row is not truncated;
+        # empty rows are left out, np.asarray([]) would make them float64
+        nonempty = [r for r in rows if len(r) > 0]
+        dtype = np.result_type(*nonempty) if len(nonempty) > 0 else np.int64
+        if dtype == np.float64 and not isinstance(samples[0], np.ndarray):
+            # python floats collate to the default float dtype, as with torch.tensor
+            dtype = np.float32
+        out = np.full((len(rows), lens.max()), self.pad_idx, dtype=dtype)
+        for i, r in enumerate(rows):
+            out[i, :lens[i]] = r
+        return torch.from_numpy(out)
 
     def size(self, index):
         return self.sizes[index]
@@ -6,100 +6,246 @@ from fairseq.models import (
 from fairseq.modules import PositionalEmbedding
 
 import torch
+from torch import Tensor
 from torch.nn import functional as F
 from torch import nn
 import math
+from typing import List, Optional, Tuple
 DEFAULT_MAX_SOURCE_POSITIONS = 1024
 DEFAULT_MAX_TARGET_POSITIONS = 1024
 
 
-def compute_conv_mask(lengths, stride):
+def compute_conv_mask(lengths, stride, max_length):
     # lengths: B
+    # max_length: T, the padded input length, known on the host so no device sync is needed
     # we use odd-number kernel
-    valid_lengths = (lengths - 1) / stride + 1
-    max_length = torch.max(valid_lengths).item()
-    mask = torch.arange(max_length, device=lengths.device).type_as(lengths).expand(len(lengths), max_length)
-    mask = mask < valid_lengths.unsqueeze(1)
+    valid_lengths = (lengths - 1) // stride + 1
+    max_length = (max_length - 1) // stride + 1
+    mask = utils.buffered_arange(max_length, lengths.device).unsqueeze(0) < valid_lengths.unsqueeze(1)
     return valid_lengths, mask  # mask -> batch x T'
 
 
 def compute_deconv_mask(original_lengths, max_pad_length, stride):
     # lengths: B
+    # max_pad_length: the padded input width (tokens or mask), so T' needs no max(lengths) sync
     # we use odd-number kernel
-    valid_lengths = (original_lengths - 1) / stride + 1
-    max_length = int((max_pad_length - 1) / stride) + 1 if max_pad_length > 0 else torch.max(valid_lengths).item()
-    mask = torch.arange(max_length, device=original_lengths.device).type_as(original_lengths).expand(len(original_lengths), max_length)
-    mask = mask < valid_lengths.unsqueeze(1)
+    valid_lengths = (original_lengths - 1) // stride + 1
+    max_length = (max_pad_length - 1) // stride + 1 if max_pad_length > 0 else torch.max(valid_lengths).item()
+    mask = utils.buffered_arange(max_length, original_lengths.device).unsqueeze(0) < valid_lengths.unsqueeze(1)
     return valid_lengths, max_length, mask  # mask -> batch x T'
 
 
+def build_norm(channels, norm='batch'):
+    if norm == 'group':
+        # per-sample statistics: no cross-replica sync under DDP
+        return nn.GroupNorm(math.gcd(32, channels), channels)
+    return nn.BatchNorm1d(channels)
+
+
+def fuse_conv_bn(conv, bn, start=0):
+    # fold an eval-mode BatchNorm1d into the conv feeding channels [start, start + out_channels) of it
+    end = start + conv.out_channels
+    with torch.no_grad():
+        scale = bn.weight[start:end] / torch.sqrt(bn.running_var[start:end] + bn.eps)
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(scale)
+        conv.weight.mul_(scale.view(-1, 1, 1))
+        conv.bias = nn.Parameter((bias - bn.running_mean[start:end]) * scale + bn.bias[start:end])
+
+
+@torch.jit.script
+def fused_embedding(tok_emb, pos_emb, scale: float, mask, p: float, training: bool):
+    # scale + position add + padding mask + dropout as one scripted pointwise chain
+    x = (tok_emb * scale + pos_emb) * mask.unsqueeze(-1)
+    return F.dropout(x, p=p, training=training)
+
+
+@torch.jit.script
+def conv_relu_mask(input: Tensor, weights: List[Tensor], biases: List[Tensor], strides: List[int],
+                   paddings: List[int], masks: List[Tensor]) -> Tensor:
+    # conv -> relu -> padding mask of every ConvEncoder layer as one scripted program
+    for i in range(len(weights)):
+        input = F.relu(F.conv1d(input, weights[i], biases[i], strides[i], paddings[i]))
+        input = input.masked_fill(~masks[i].unsqueeze(1), 0.)
+    return input
+
+
+def conv_encoder_forward(encoder, input, conv_masks):
+    for conv_layer, new_mask in zip(encoder.conv_blocks, conv_masks):
+        input = F.relu(conv_layer(input))
+        input = input.masked_fill(~new_mask.unsqueeze(1), 0.)
+    output = encoder.quant_conv(input)
+    # output: batch x C' x T' -> T' x batch x C'
+    # new_mask: batch x T'
+    return output.permute(2, 0, 1), new_mask
+
+
+_compiled_conv_encoder_forward = None
+
+
+def compiled_conv_encoder_forward():
+    # compiled once per process and shared by all ConvEncoders; the module is passed in explicitly,
+    # so replicas and pickled copies never hold a reference to the compiled function
+    global _compiled_conv_encoder_forward
+    if _compiled_conv_encoder_forward is None:
+        # let inductor fuse the relu + mask postamble of each conv;
+        # dynamic shapes avoid recompiling for every new T
+        _compiled_conv_encoder_forward = torch.compile(conv_encoder_forward, mode='reduce-overhead', dynamic=True)
+    return _compiled_conv_encoder_forward
+
+
 class ConvEncoder(nn.Module):
-    def __init__(self, input_channel, kernels, strides, latent_dim):
+    def __init__(self, input_channel, kernels, strides, latent_dim, compile_forward=False):
         super().__init__()
         self.strides = strides
         self.conv_blocks = nn.ModuleList([])
         self.conv_blocks.extend([nn.Conv1d(input_channel, input_channel, kernel_size=k, padding=k//2, stride=s)
                                  for k, s in zip(kernels, strides)])
         self.quant_conv = nn.Conv1d(input_channel, latent_dim, 1)
+        self.compile_forward = compile_forward and hasattr(torch, 'compile')
 
-    def forward(self, input, length):
+    def forward(self, input: Tensor, length: Tensor,
+                conv_masks: Optional[List[Tensor]] = None) -> Tuple[Tensor, Tensor]:
         # input: batch x C x T
-        new_mask = None
-        for ii, (conv_layer, s) in enumerate(zip(self.conv_blocks, self.strides)):
-            input = F.relu(conv_layer(input))
-            length, new_mask = compute_conv_mask(length, s)
-            input = input * new_mask.type_as(input).unsqueeze(1)
-        output = self.quant_conv(input)
-        # output: batch x C' x T' -> T' x batch x C'
-        # new_mask: batch x T'
-        return output.permute(2, 0, 1), new_mask
+        # conv_masks: optional precomputed batch x T_i masks, one per conv layer
+        if conv_masks is None:
+            # build every layer's mask up front, so the (optionally compiled) conv stack is a straight chain
+            conv_masks = []
+            max_length = input.size(-1)
+            for s in self.strides:
+                length, mask = compute_conv_mask(length, s, max_length)
+                max_length = mask.size(1)
+                conv_masks.append(mask)
+        if self.compile_forward:
+            return compiled_conv_encoder_forward()(self, input, conv_masks)
+        return self._scripted_forward(input, conv_masks)
+
+    def _scripted_forward(self, input, conv_masks):
+        input = conv_relu_mask(input, [conv.weight for conv in self.conv_blocks],
+                               [conv.bias for conv in self.conv_blocks], list(self.strides),
+                               [conv.padding[0] for conv in self.conv_blocks], list(conv_masks))
+        return self.quant_conv(input).permute(2, 0, 1), conv_masks[-1]
 
 
 class MultiKernelConvBlock(nn.Module):
-    def __init__(self, input_channel, kernels, stride, single_output_channel):
+    def __init__(self, input_channel, kernels, stride, single_output_channel, channels_last=False, norm='batch'):
         super().__init__()
         self.stride = stride
         self.kernels = kernels
+        self.channels_last = channels_last
+        self.norm = norm
+
+        # time padding of the merged conv window and of each kernel inside it, see merged_conv
+        left = max(k // 2 for k in kernels)
+        right = max((k - 1) // 2 for k in kernels)
+        self._input_pad = (left, right)
+        self._pad_specs = []
+        for k in kernels:
+            pad = (left - k // 2, right - (k - 1) // 2)
+            self._pad_specs.append((pad != (0, 0), pad))
+        # inference cache of the packed weights, one attribute per stage, see packed_weight
+        self._packed_conv_block_1 = None
+        self._packed_conv_block_2 = None
 
         output_channel = single_output_channel * len(kernels)
         self.conv_block_1 = nn.ModuleList([])
         self.conv_block_1.extend([nn.Conv1d(input_channel, single_output_channel, kernel_size=k,
                                             padding=k//2 if k % 2 != 0 else 0, stride=stride) for k in kernels])
-        self.bn1 = nn.BatchNorm1d(output_channel)
+        self.bn1 = build_norm(output_channel, norm)
 
         self.conv_block_2 = nn.ModuleList([])
         self.conv_block_2.extend([nn.Conv1d(output_channel, single_output_channel, kernel_size=k,
                                             padding=k//2 if k % 2 != 0 else 0, stride=1) for k in kernels])
-        self.bn2 = nn.BatchNorm1d(output_channel)
+        self.bn2 = build_norm(output_channel, norm)
 
         self.downsample = nn.Sequential(nn.Conv1d(input_channel, output_channel, 1, stride=stride),
-                                        nn.BatchNorm1d(output_channel))
+                                        build_norm(output_channel, norm))
 
-    def forward(self, x, input_length, pad_num=0):
+    def forward(self, x: Tensor, input_length: Tensor, pad_num: int = 0,
+                mask: Optional[Tensor] = None) -> Tuple[Tensor, Tensor, Tensor]:
         # input: batch x C x T
+        # mask: optional precomputed batch x T' output mask
 
-        new_length, new_mask = compute_conv_mask(input_length, self.stride)
+        if mask is not None:
+            new_length, new_mask = (input_length - 1) // self.stride + 1, mask
+        else:
+            new_length, new_mask = compute_conv_mask(input_length, self.stride, x.size(-1))
         residual = self.downsample(x)
-        mask = new_mask.type_as(residual)
+        pad_mask = ~new_mask.unsqueeze(1)
 
-        outs = [self.conv_block_1[ii](x if k % 2 != 0 else F.pad(x, (k//2, k//2-1), 'constant', 0))
-                for ii, k in enumerate(self.kernels)]
-        out = torch.cat(outs, dim=1)
+        out = self.merged_conv(x, 'conv_block_1', self.stride)
         out = self.bn1(out)
         out = F.relu(out)
 
-        out = out * mask.unsqueeze(1)
-        outs = [self.conv_block_2[ii](out if k % 2 != 0 else F.pad(out, (k//2, k//2-1), 'constant', 0))
-                for ii, k in enumerate(self.kernels)]
-        out = torch.cat(outs, dim=1)
+        out = out.masked_fill(pad_mask, 0.)
+        out = self.merged_conv(out, 'conv_block_2', 1)
         out = self.bn2(out)
 
         out = out + residual
         out = F.relu(out)
 
-        out = out * mask.unsqueeze(1)
+        out = out.masked_fill(pad_mask, 0.)
         return out, new_length, new_mask
 
+    def fuse_bn(self):
+        if self.norm != 'batch':
+            return
+        assert not self.training, 'BatchNorm can only be folded into the convs in eval mode'
+        for convs, bn_name in ((self.conv_block_1, 'bn1'), (self.conv_block_2, 'bn2')):
+            bn = getattr(self, bn_name)
+            for ii, conv in enumerate(convs):
+                fuse_conv_bn(conv, bn, start=ii * conv.out_channels)
+            setattr(self, bn_name, nn.Identity())
+        fuse_conv_bn(self.downsample[0], self.downsample[1])
+        self.downsample[1] = nn.Identity()
+
+    def _apply(self, *args, **kwargs):
+        # .to() / .cuda() / .half() leave the packed copies on the old device or dtype
+        self._packed_conv_block_1 = None
+        self._packed_conv_block_2 = None
+        return super()._apply(*args, **kwargs)
+
+    def packed_weight(self, stage):
+        # pack the per-kernel weights of stage ('conv_block_1' or 'conv_block_2') into one
+        # K*out_c x in_c x W tensor (K*out_c x in_c x 1 x W in channels_last layout for the conv2d path);
+        # when no gradient is needed (inference) the packed copy is kept until one of the parameters changes.
+        # the cache is a plain attribute per stage, so copies and replicas overwrite their own entry
+        convs = getattr(self, stage)
+        cache_name = '_packed_' + stage
+        params = [p for conv in convs for p in (conv.weight, conv.bias)]
+        requires_grad = torch.is_grad_enabled() and any(p.requires_grad for p in params)
+        key = tuple((p.data_ptr(), p._version) for p in params)
+        cached = getattr(self, cache_name)
+        if not requires_grad and cached is not None and cached[0] == key:
+            return cached[1], cached[2]
+
+        weights = []
+        for conv, (needs_pad, pad) in zip(convs, self._pad_specs):
+            weights.append(F.pad(conv.weight, pad) if needs_pad else conv.weight)
+        weight = torch.cat(weights, dim=0)
+        if self.channels_last:
+            weight = weight.unsqueeze(2).contiguous(memory_format=torch.channels_last)
+        bias = torch.cat([conv.bias for conv in convs], dim=0)
+        setattr(self, cache_name, None if requires_grad else (key, weight, bias))
+        return weight, bias
+
+    def merged_conv(self, x, stage, stride):
+        # run all kernels of one stage as a single conv instead of one conv + cat per kernel:
+        # every kernel is zero-padded in time so that it lines up with the others inside a
+        # shared window of width left + right + 1 (odd k is centered, even k uses (k//2, k//2-1))
+        # convs only hold the parameters, so checkpoints keep the per-kernel layout
+        left, right = self._input_pad
+        weight, bias = self.packed_weight(stage)
+        padding = left
+        if left != right:
+            x = F.pad(x, (left, right))
+            padding = 0
+        if self.channels_last:
+            # run as a (1 x k) conv2d on a B x C x 1 x T view so cudnn can pick its NHWC kernels
+            x = x.unsqueeze(2).contiguous(memory_format=torch.channels_last)
+            out = F.conv2d(x, weight, bias, stride=(1, stride), padding=(0, padding))
+            return out.squeeze(2)
+        return F.conv1d(x, weight, bias, stride=stride, padding=padding)
+
 
 class FullConvEncoder(FairseqEncoder):
     def __init__(self, args, input_channel, kernels, strides, latent_dim, embed_tokens, dictionary):
@@ -115,37 +261,65 @@ class FullConvEncoder(FairseqEncoder):
         single_kernel_channel = 256
         input_channels = [input_channel] + [single_kernel_channel * len(kk) for kk in kernels]
         self.conv_blocks = nn.ModuleList([])
-        self.conv_blocks.extend([MultiKernelConvBlock(d, k, s, single_kernel_channel)
+        self.conv_blocks.extend([MultiKernelConvBlock(d, k, s, single_kernel_channel,
+                                                      channels_last=getattr(args, 'conv_channels_last', 0),
+                                                      norm=getattr(args, 'conv_norm', 'batch'))
                                  for k, s, d in zip(kernels, strides, input_channels[:-1])])
         self.quant_conv = nn.Conv1d(input_channels[-1], latent_dim, 1)
         self.dropout = args.dropout
+        self.bf16 = getattr(args, 'conv_encoder_bf16', 0)
+        if self.bf16 and getattr(args, 'fp16', False):
+            # the half model would get bf16 activations next to fp16 BatchNorm/quantizer weights
+            raise ValueError('--conv-encoder-bf16 is not supported together with --fp16')
 
         self.pad_index = dictionary.pad_index
         self.bos_index = dictionary.bos_index
+        if hasattr(torch, 'isin'):
+            # token ids left out of the encoding, matched in one kernel by torch.isin
+            self.register_buffer('_skip_ids', torch.LongTensor([self.pad_index, self.bos_index]), persistent=False)
+        else:
+            self._skip_ids = None
 
-    def forward_embedding(self, src_tokens):
-        # embed tokens and positions
-        embed = self.embed_scale * self.embed_tokens(src_tokens)
-        if self.embed_positions is not None:
-            x = embed + self.embed_positions(src_tokens)
-        x = F.dropout(x, p=self.dropout, training=self.training)
+    def forward_embedding(self, src_tokens, encoding_mask):
+        # embed tokens and positions, masked and with dropout applied
+        embed = self.embed_tokens(src_tokens)
+        x = fused_embedding(embed, self.embed_positions(src_tokens), self.embed_scale,
+                            encoding_mask.type_as(embed), self.dropout, self.training)
         return x, embed
 
-    def forward(self, src_tokens, length, pad_num=0):
-        x, encoder_embedding = self.forward_embedding(src_tokens)
-        encoding_mask = (~(src_tokens.eq(self.pad_index) | src_tokens.eq(self.bos_index))).type_as(x)
-        x = x * (encoding_mask.unsqueeze(-1))  # B x T x C
-        x = x.transpose(1, 2)
-        for block in self.conv_blocks:
-            x, length, mask = block(x, length)
-        x = self.quant_conv(x)  # B x C x T'
+    def forward(self, src_tokens: Tensor, length: Tensor, pad_num: int = 0,
+                conv_masks: Optional[List[Tensor]] = None) -> Tuple[Tensor, Tensor]:
+        if self._skip_ids is not None:
+            encoding_mask = torch.isin(src_tokens, self._skip_ids, invert=True)
+        else:
+            encoding_mask = ~(src_tokens.eq(self.pad_index) | src_tokens.eq(self.bos_index))
+        x, encoder_embedding = self.forward_embedding(src_tokens, encoding_mask)  # B x T x C
+        if conv_masks is None or pad_num > 0:
+            # precomputed masks only cover the unpadded batch
+            conv_masks = [None] * len(self.conv_blocks)
+        if self.bf16 and x.is_cuda:
+            # the conv stack is memory bound, run it in bf16 and hand the latents back in the model dtype
+            orig_dtype = x.dtype
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16):
+                x, mask = self.forward_conv_blocks(x.to(torch.bfloat16).transpose(1, 2), length, conv_masks)
+            x = x.to(orig_dtype)
+        else:
+            x, mask = self.forward_conv_blocks(x.transpose(1, 2), length, conv_masks)
         return x.permute(2, 0, 1), mask
 
+    def forward_conv_blocks(self, x, length, conv_masks):
+        # x: B x C x T
+        for block, conv_mask in zip(self.conv_blocks, conv_masks):
+            x, length, mask = block(x, length, mask=conv_mask)
+        x = self.quant_conv(x)  # B x C x T'
+        return x, mask
+
 
 class ConvBlock(nn.Module):
-    def __init__(self, input_channel, kernel, stride, output_channel=None, use_stride_first=True):
+    def __init__(self, input_channel, kernel, stride, output_channel=None, use_stride_first=True, norm='batch'):
         super().__init__()
         self.stride = stride
+        self.norm = norm
         if output_channel is None:
             output_channel = input_channel
 
@@ -153,27 +327,27 @@ class ConvBlock(nn.Module):
 
         if not use_stride_first:
             self.conv0 = nn.Conv1d(input_channel, output_channel, kernel_size=kernel, padding=kernel//2)
-            self.bn0 = nn.BatchNorm1d(output_channel)
+            self.bn0 = build_norm(output_channel, norm)
         self.conv1 = nn.Conv1d(input_channel, output_channel, kernel_size=kernel, padding=kernel//2, stride=stride)
-        self.bn1 = nn.BatchNorm1d(output_channel)
+        self.bn1 = build_norm(output_channel, norm)
         self.conv2 = nn.Conv1d(input_channel, output_channel, kernel_size=kernel, padding=kernel//2)
-        self.bn2 = nn.BatchNorm1d(output_channel)
+        self.bn2 = build_norm(output_channel, norm)
         self.downsample = nn.Sequential(nn.Conv1d(input_channel, output_channel, 1, stride=stride),
-                                        nn.BatchNorm1d(output_channel))
+                                        build_norm(output_channel, norm))
 
-    def forward(self, x, input_length, pad_length=0):
+    def forward(self, x: Tensor, input_length: Tensor, pad_length: int = 0) -> Tuple[Tensor, Tensor, Tensor, int]:
         # input: batch x C x T
         # new_padded_length is max length
         new_length, new_padded_length, new_mask = compute_deconv_mask(input_length, pad_length, self.stride)
         residual = self.downsample(x)
-        mask = new_mask.type_as(residual)
+        pad_mask = ~new_mask.unsqueeze(1)
 
         if self.use_stride_first:
             out = self.conv1(x)
             out = self.bn1(out)
             out = F.relu(out)
 
-            out = out * mask.unsqueeze(1)
+            out = out.masked_fill(pad_mask, 0.)
             out = self.conv2(out)
             out = self.bn2(out)
 
@@ -188,16 +362,27 @@ class ConvBlock(nn.Module):
             out = self.bn1(out)
             out = F.relu(out)
 
-            out = out * mask.unsqueeze(1)
+            out = out.masked_fill(pad_mask, 0.)
             out = self.conv2(out)
             out = self.bn2(out)
 
             out = out + residual
             out = F.relu(out)
 
-        out = out * mask.unsqueeze(1)
+        out = out.masked_fill(pad_mask, 0.)
         return out, new_length, new_mask, new_padded_length
 
+    def fuse_bn(self):
+        if self.norm != 'batch':
+            return
+        assert not self.training, 'BatchNorm can only be folded into the convs in eval mode'
+        names = ['1', '2'] if self.use_stride_first else ['0', '1', '2']
+        for name in names:
+            fuse_conv_bn(getattr(self, 'conv' + name), getattr(self, 'bn' + name))
+            setattr(self, 'bn' + name, nn.Identity())
+        fuse_conv_bn(self.downsample[0], self.downsample[1])
+        self.downsample[1] = nn.Identity()
+
 
 class SingleKernelFullConvEncoder(FairseqEncoder):
     # kernel is the same
@@ -217,7 +402,8 @@ class SingleKernelFullConvEncoder(FairseqEncoder):
             strides.extend([1, 1])
 
         self.conv_blocks = nn.ModuleList([])
-        self.conv_blocks.extend([ConvBlock(input_channel, k, s, use_stride_first=getattr(args, 'use_stride_first', True))
+        self.conv_blocks.extend([ConvBlock(input_channel, k, s, use_stride_first=getattr(args, 'use_stride_first', True),
+                                           norm=getattr(args, 'conv_norm', 'batch'))
                                  for k, s in zip(kernels, strides)])
         self.quant_conv = nn.Conv1d(input_channel, latent_dim, 1)
         self.dropout = args.dropout
@@ -230,12 +416,12 @@ class SingleKernelFullConvEncoder(FairseqEncoder):
         x = F.dropout(x, p=self.dropout, training=self.training)
         return x, embed
 
-    def forward(self, src_tokens, length, pad_num=0):
+    def forward(self, src_tokens, length, pad_num=0, conv_masks=None):
         x, encoder_embedding = self.forward_embedding(src_tokens)
         encoding_mask = src_tokens.ne(self.pad_index).type_as(x)
         x = x * (encoding_mask.unsqueeze(-1))  # B x T x C
         x = x.transpose(1, 2)
-        pad_length = torch.max(length).item() + pad_num
+        pad_length = src_tokens.size(1)
         for block in self.conv_blocks:
             x, length, mask, pad_length = block(x, length, pad_length)
         x = self.quant_conv(x)  # B x C x T'
@@ -257,20 +443,20 @@ class DeConvBlock(nn.Module):
         # input: batch x C x T
         # x is the compressed latent vectors, forward will expand it to the original size
         residual = self.upsample(x)
-        m = mask.type_as(residual)
+        pad_mask = ~mask.unsqueeze(1)
 
         out = self.deconv1(x)
         out = self.bn1(out)
         out = F.relu(out)
 
-        out = out * m.unsqueeze(1)
+        out = out.masked_fill(pad_mask, 0.)
         out = self.deconv2(out)
         out = self.bn2(out)
 
         out = out + residual
         out = F.relu(out)
 
-        out = out * m.unsqueeze(1)
+        out = out.masked_fill(pad_mask, 0.)
         return out
 
 
@@ -288,7 +474,7 @@ class SingleKernelFullDeConvEncoder(FairseqEncoder):
         self.bos_index = dictionary.bos_index
 
     def forward(self, x, original_lengths, pad_num, mask):
-        pad_length = torch.max(original_lengths).item() + pad_num
+        pad_length = mask.size(1)
         forward_masks = [mask]
         for s in self.strides[::-1]:
             original_lengths, _, mask = compute_deconv_mask(original_lengths, pad_length, s)
@@ -319,7 +505,7 @@ class ConvBlockEven(nn.Module):
     def forward(self, x, mask):
         # input: batch x C x T
         residual = self.downsample(x)
-        mask = mask.type_as(residual)
+        pad_mask = ~mask.unsqueeze(1)
 
         out = self.conv0(x)
         out = self.bn0(out)
@@ -329,22 +515,21 @@ class ConvBlockEven(nn.Module):
         out = self.conv1(out)
         out = self.bn1(out)
         out = F.relu(out)
-        out = out * mask.unsqueeze(1)
+        out = out.masked_fill(pad_mask, 0.)
 
         out = self.conv2(out)
         out = self.bn2(out)
         out = out + residual
         out = F.relu(out)
 
-        out = out * mask.unsqueeze(1)
+        out = out.masked_fill(pad_mask, 0.)
         return out
 
 
 def compute_conv_even_mask(lengths, max_length):
     # lengths: B
     valid_lengths = (lengths + 1) // 2
-    mask = torch.arange(max_length, device=lengths.device).type_as(lengths).expand(len(lengths), max_length)
-    mask = mask < valid_lengths.unsqueeze(1)
+    mask = utils.buffered_arange(max_length, lengths.device).unsqueeze(0) < valid_lengths.unsqueeze(1)
     return valid_lengths, mask  # mask -> batch x T'
 
 
@@ -376,7 +561,7 @@ class SingleKernelFullConvNoOverlapEncoder(FairseqEncoder):
         x = F.dropout(x, p=self.dropout, training=self.training)
         return x, embed
 
-    def forward(self, src_tokens, length, pad_num=0):
+    def forward(self, src_tokens, length, pad_num=0, conv_masks=None):
         x, encoder_embedding = self.forward_embedding(src_tokens)
         encoding_mask = src_tokens.ne(self.pad_index).type_as(x)
         x = x * (encoding_mask.unsqueeze(-1))  # B x T x C
@@ -405,20 +590,20 @@ class DeConvBlockEven(nn.Module):
         # input: batch x C x T
         # x is the compressed latent vectors, forward will expand it to the original size
         residual = self.upsample(x)
-        m = mask.type_as(residual)
+        pad_mask = ~mask.unsqueeze(1)
 
         out = self.deconv1(x)
         out = self.bn1(out)
         out = F.relu(out)
 
-        out = out * m.unsqueeze(1)
+        out = out.masked_fill(pad_mask, 0.)
         out = self.deconv2(out)
         out = self.bn2(out)
 
         out = out + residual
         out = F.relu(out)
 
-        out = out * m.unsqueeze(1)
+        out = out.masked_fill(pad_mask, 0.)
         return out
 
 
@@ -436,9 +621,9 @@ class SingleKernelFullDeConvNoOverlapEncoder(FairseqEncoder):
         self.bos_index = dictionary.bos_index
 
     def forward(self, x, original_lengths, pad_num, mask):
-        pad_length = torch.max(original_lengths).item() + pad_num
+        pad_length = mask.size(1)
         forward_masks = [mask]
-        max_len = torch.max(original_lengths + pad_num) // 2
+        max_len = pad_length // 2
         for s in self.strides[::-1]:
             original_lengths, mask = compute_conv_even_mask(original_lengths, max_len)
             max_len = mask.size(-1) // 2
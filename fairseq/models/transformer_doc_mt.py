@@ -184,7 +184,7 @@ class TransformerContextModel(FairseqEncoderDecoderModel):
                 tgt_dict, args.decoder_embed_dim, args.decoder_embed_path
             )
 
-        code_embed_init = task.ctx_model.bottom_quantizer.embed.transpose(0, 1) if hasattr(args, 'codebook_size') else None
+        code_embed_init = task.ctx_model.bottom_quantizer.codebook if hasattr(args, 'codebook_size') else None
         encoder = cls.build_encoder(args, src_dict, encoder_embed_tokens, code_embed_init)
         decoder = cls.build_decoder(args, tgt_dict, decoder_embed_tokens)
         return cls(encoder, decoder)
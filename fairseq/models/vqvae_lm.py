@@ -9,7 +9,9 @@ from fairseq.models.typed_transformer import (
     TransformerEncoder,
 )
 from fairseq.models.conv_encoder import (
+    ConvBlock,
     ConvEncoder,
+    MultiKernelConvBlock,
     FullConvEncoder,
     SingleKernelFullConvEncoder,
     SingleKernelFullDeConvEncoder,
@@ -48,8 +50,13 @@ def parse_kernel_and_strides(kernel, stride):
 
 
 def print_stats(stats):
-    for k, v in stats.items():
-        print("{} = {}".format(k, v.item()))
+    if len(stats) == 0:
+        return
+    keys = list(stats.keys())
+    # one device-to-host copy for all entries instead of an .item() sync per entry
+    vals = torch.stack([torch.as_tensor(stats[k]).detach().float().view(-1)[0] for k in keys]).cpu().tolist()
+    for k, v in zip(keys, vals):
+        print("{} = {}".format(k, v))
 
 
 def sample_topp(probs, mask, sampling_topp=0.9):
@@ -140,6 +147,8 @@ class Quantize(nn.Module):
         self.anneal_steps = args.soft_temp_anneal_steps
         self.samples = args.soft_samples
         self.disable_mea = getattr(args, 'disable_mea', 0)
+        self.bf16_dist = getattr(args, 'quantize_bf16_dist', 0)
+        self.collect_stats = getattr(args, 'quantize_collect_stats', 0)
         self.is_emb_param = param_emb
         if param_emb:
             self.embed = nn.Parameter(torch.normal(mean=0, std=dim ** -0.5, size=(dim, n_embed+1)), requires_grad=True)
@@ -149,18 +158,38 @@ class Quantize(nn.Module):
             # disable mea works better with less exploration
             self.embed = nn.Parameter(torch.normal(mean=0, std=dim ** -0.5, size=(dim, n_embed)), requires_grad=True)
         else:
-            # embed = torch.randn(dim, n_embed)
-            embed = torch.normal(mean=0, std=dim ** -0.5, size=(dim, n_embed))
+            # embed = torch.randn(n_embed, dim)
+            embed = torch.normal(mean=0, std=dim ** -0.5, size=(n_embed, dim))
             self.register_buffer('embed', embed)
 
+        # EMA codebooks are stored as K x C (embedding-table layout); learned codebooks keep the C x K
+        # parameter layout, so optimizer states of existing runs still load
+        self.kc_layout = not isinstance(self.embed, nn.Parameter)
+
         self.register_buffer('cluster_size', torch.zeros(n_embed))
-        self.register_buffer('embed_avg', self.embed.clone())
+        self.register_buffer('embed_avg', self.embed.clone())  # same layout as embed
+        if self.kc_layout:
+            # ||e_k||^2 of the EMA codebook, refreshed together with it
+            self.register_buffer('embed_sqnorm', self.codebook.pow(2).sum(1))
+        else:
+            # learned codebooks change under the optimizer, their norms are recomputed every forward
+            self.register_buffer('embed_sqnorm', None)
+        # codebook layout: 2 for K x C, 1 for C x K
+        self.register_buffer('version', torch.Tensor([2 if self.kc_layout else 1]))
 
         self.exploration_steps = args.quantize_explore_steps
         self.most_attend_k = int(self.n_embed * 0.6)
 
         self.commit_weight = args.commitment_cost
 
+    def _kc(self, t):
+        # K x C view of a tensor stored in the codebook layout
+        return t if self.kc_layout else t.t()
+
+    @property
+    def codebook(self):
+        return self._kc(self.embed)  # K x C
+
     def get_temperature(self, updates):
         if updates == -1 or self.anneal_steps <= 0:
             return self.min_temp
@@ -173,25 +202,38 @@ class Quantize(nn.Module):
             else:
                 return self.max_temp - (updates - self.anneal_steps) * 1.0 / self.anneal_steps * self.diff_temp
 
-    def forward(self, input, input_mask, updates=-1, prefix="", extract_code_only=False, code_extract_strategy=None):
+    def forward(self, input, input_mask, updates=-1, prefix="", extract_code_only=False, code_extract_strategy=None,
+                collect_stats=None):
         '''
         :param input: T x batch x C, number of channels: dimension C
         :param input_mask: T x batch
+        :param collect_stats: log codebook usage statistics, defaults to self.collect_stats; training only
         :return:
         '''
+        if collect_stats is None:
+            collect_stats = self.collect_stats
 
         if self.is_emb_param and not self.disable_mea:
-            embed = self.embed.detach()
+            embed = self.codebook.detach()
         else:
-            embed = self.embed
+            embed = self.codebook  # K x C
 
         # S = T x B
         flatten = input.reshape(-1, self.dim)  # S x C
-        dist = (
-            flatten.pow(2).sum(1, keepdim=True)  # S x 1
-            - 2 * flatten @ embed   # S x C @ C x K
-            + embed.pow(2).sum(0, keepdim=True)  # 1 x K
-        )  # S x K
+        mask1d = input_mask.view(-1).bool()  # S
+        mask_f = input_mask.to(dtype=input.dtype)  # T x batch
+        # ||x||^2 is constant along each row, so it changes neither the argmin nor the softmax over codes
+        if self.embed_sqnorm is not None:
+            embed_sqnorm = self.embed_sqnorm
+        else:
+            embed_sqnorm = embed.pow(2).sum(1)  # K
+        if self.bf16_dist and not self.soft and flatten.is_cuda:
+            # hard codes only need the ordering of the distances, so run the S x C x K GEMM in bf16;
+            # the codebook itself and its EMA statistics stay in fp32
+            dist = torch.addmm(embed_sqnorm.to(torch.bfloat16), flatten.to(torch.bfloat16), embed.t().to(torch.bfloat16),
+                               beta=1, alpha=-2)  # S x K
+        else:
+            dist = torch.addmm(embed_sqnorm, flatten, embed.t(), beta=1, alpha=-2)  # S x C @ C x K -> S x K
 
         if self.is_emb_param:
             dist[:, -1] = float('inf')
@@ -201,7 +243,6 @@ class Quantize(nn.Module):
             most_attend_codes = sorted_indices[:self.most_attend_k]
             dist = dist.index_fill_(1, most_attend_codes, float('inf'))
 
-        stats = {}
         if self.soft:
             tau = self.get_temperature(updates)
             if self.training or code_extract_strategy is None or code_extract_strategy == 'soft':
@@ -222,7 +263,7 @@ class Quantize(nn.Module):
                 embed_ind = [probs, embed_ind]
             elif not self.training and code_extract_strategy == 'topp':
                 probs = F.softmax(-dist / tau, -1)
-                trimmed_probs, embed_ind, topp_mask = sample_topp(probs, input_mask.flatten(), sampling_topp=0.9)  # embed_ind: S x ?
+                trimmed_probs, embed_ind, topp_mask = sample_topp(probs, mask1d, sampling_topp=0.9)  # embed_ind: S x ?
                 trimed_probs = trimmed_probs[:, :5]
                 embed_ind = embed_ind[:, :5]
                 trimed_probs = trimed_probs / trimed_probs.sum(-1).unsqueeze(-1)
@@ -235,65 +276,108 @@ class Quantize(nn.Module):
                 embed_ind = torch.gather(embed_ind, 1, rand_index.unsqueeze(1))
                 embed_onehot = F.one_hot(embed_ind, self.n_embed).type_as(flatten)
             elif not self.training and code_extract_strategy == 'argmax':
-                _, embed_ind = (-dist).max(1)  # S
+                _, embed_ind = dist.min(1)  # S
                 embed_onehot = F.one_hot(embed_ind, self.n_embed).type_as(flatten)  # S x K
             if extract_code_only:
                 return embed_onehot
             if embed_ind is None:
                 _, embed_ind = (-dist).topk(k=5, largest=True, dim=-1)  # S x K
-            quantize = (embed_onehot @ embed.transpose(0, 1)).view(input.size(0), input.size(1), self.dim)
+            quantize = (embed_onehot @ embed).view(input.size(0), input.size(1), self.dim)
         else:
-            _, embed_ind = (-dist).max(1)  # S
-            embed_onehot = F.one_hot(embed_ind, self.n_embed).type_as(flatten)  # S x K
+            _, embed_ind = dist.min(1)  # S
             if extract_code_only:
-                return embed_onehot
+                return F.one_hot(embed_ind, self.n_embed).type_as(flatten)  # S x K
+            # hard codes are counted with bincount / index_add_ below instead of an S x K one-hot matrix
+            embed_onehot = None
             quantize = self.embed_code(embed_ind.view(*input.shape[:-1]))  # T X batch x C
 
-        effective_units = 1.0 / embed_onehot[input_mask.view(-1)].mean(0).pow(2).sum()
-        stats[prefix + 'effective latents per batch'] = effective_units
+        stats = {}
         if self.training:
-            unmasked_flatten = torch.masked_select(flatten, input_mask.view(-1, 1)).contiguous().view(-1, self.dim)  # num_latents x C
-            unmasked_embed_onehot = torch.masked_select(embed_onehot, input_mask.view(-1, 1)).contiguous().view(-1, self.n_embed)  # num_latents x K
+            # gather the unmasked rows once; stats and the EMA update share them
+            idx = torch.nonzero(mask1d).view(-1)  # num_latents
+            if embed_onehot is None:
+                unmasked_embed_ind = embed_ind.index_select(0, idx)  # num_latents
+                cluster_sum = torch.bincount(unmasked_embed_ind, minlength=self.n_embed).type_as(flatten)  # K
+            else:
+                unmasked_embed_onehot = embed_onehot.index_select(0, idx)  # num_latents x K
+                cluster_sum = unmasked_embed_onehot.sum(0)
+
+            if collect_stats:
+                effective_units = 1.0 / (cluster_sum / cluster_sum.sum()).pow(2).sum()
+                stats[prefix + 'effective latents per batch'] = effective_units
 
-            cluster_sum = unmasked_embed_onehot.sum(0)
-            if torch.cuda.device_count() > 1:
-                torch.distributed.all_reduce(cluster_sum)
+            if not self.disable_mea:
+                unmasked_flatten = flatten.index_select(0, idx)  # num_latents x C
+                if embed_onehot is None:
+                    embed_sum = flatten.new_zeros(self.n_embed, self.dim).index_add_(
+                        0, unmasked_embed_ind, unmasked_flatten)  # K x C
+                else:
+                    embed_sum = unmasked_embed_onehot.t() @ unmasked_flatten  # K x C
+            if torch.distributed.is_available() and torch.distributed.is_initialized():
+                if self.disable_mea:
+                    torch.distributed.all_reduce(cluster_sum)
+                else:
+                    # sync both statistics with a single collective
+                    flat = torch.cat([cluster_sum, embed_sum.view(-1)])
+                    torch.distributed.all_reduce(flat)
+                    cluster_sum = flat[:self.n_embed]
+                    embed_sum = flat[self.n_embed:].view_as(embed_sum)
             self.cluster_size.data.mul_(self.decay).add_(
                 1 - self.decay, cluster_sum
             )
 
             if not self.disable_mea:
-                embed_sum = unmasked_flatten.transpose(0, 1) @ unmasked_embed_onehot  # C x K
-                if torch.cuda.device_count() > 1:
-                    torch.distributed.all_reduce(embed_sum)
-                self.embed_avg.data.mul_(self.decay).add_(
+                embed_avg = self._kc(self.embed_avg.data)
+                embed_avg.mul_(self.decay).add_(
                     1 - self.decay, embed_sum
                 )
                 n = self.cluster_size.sum()
                 cluster_size = (
                     (self.cluster_size + self.eps) / (n + self.n_embed * self.eps) * n
                 )
-                embed_normalized = self.embed_avg / cluster_size.unsqueeze(0)
+                embed_normalized = embed_avg / cluster_size.unsqueeze(1)
 
                 with torch.no_grad():
-                    self.embed.data.copy_(embed_normalized)
+                    self._kc(self.embed.data).copy_(embed_normalized)
+                    if self.embed_sqnorm is not None:
+                        self.embed_sqnorm.copy_(embed_normalized.pow(2).sum(1))
 
-        input_mask = input_mask.type_as(input)
-        quantize = quantize * input_mask.unsqueeze(-1)
-        input = input * input_mask.unsqueeze(-1)
-        diff = (quantize.detach() - input).pow(2).mean()
+        # average over valid positions only instead of zeroing padding in both operands first;
+        # count and sum in fp32, a half-precision count of positions is inexact above 2048 and overflows past 65504
+        num_valid = mask1d.sum().clamp(min=1).float()
+        diff = ((quantize.detach() - input).pow(2).mean(-1) * mask_f).sum(dtype=torch.float32) / num_valid
 
         if self.disable_mea:
-            diff = diff + (quantize - input.detach()).pow(2).mean() / self.commit_weight
+            diff = diff + ((quantize - input.detach()).pow(2).mean(-1) * mask_f).sum(dtype=torch.float32) \
+                / num_valid / self.commit_weight
+        diff = diff.type_as(input)
         quantize = input + (quantize - input).detach()
+        # the deconv path convolves over the quantized sequence, so padding still has to leave as zeros
+        quantize = quantize.masked_fill(~mask1d.view(*input.shape[:-1], 1), 0.)
 
         if self.is_emb_param and self.soft:
             # this will be used to train AT prior
-            _, embed_ind = (-dist).max(1)
+            _, embed_ind = dist.min(1)
         return quantize, diff, embed_ind, stats
 
     def embed_code(self, embed_id):
-        return F.embedding(embed_id, self.embed.transpose(0, 1))
+        return F.embedding(embed_id, self.codebook)
+
+    def upgrade_state_dict_named(self, state_dict, name):
+        prefix = name + '.' if name != '' else ''
+        version_key = prefix + 'version'
+        version = 2 if self.kc_layout else 1
+        if utils.item(state_dict.get(version_key, torch.Tensor([1]))[0]) != version:
+            # checkpoints before version 2, or from a quantizer of the other codebook kind, use the other layout
+            for key in ('embed', 'embed_avg'):
+                state_dict[prefix + key] = state_dict[prefix + key].t().contiguous()
+        state_dict[version_key] = torch.Tensor([version])
+        # embed_sqnorm is derived from the codebook: rebuild it for EMA codebooks (older checkpoints lack it)
+        # and drop it for learned ones, so EMA and --disable-mea checkpoints load into each other
+        state_dict.pop(prefix + 'embed_sqnorm', None)
+        if self.embed_sqnorm is not None:
+            state_dict[prefix + 'embed_sqnorm'] = state_dict[prefix + 'embed'].pow(2).sum(1)
+        return state_dict
 
 
 @register_model('vqvae_lm')
@@ -488,6 +572,16 @@ class VQVAE(FairseqLanguageModel):
         parser.add_argument('--use-seg-pos-emb', default=0, type=int,
                             help='used when encoder form is append')
         parser.add_argument('--use-stride-first', default=0, type=int)
+        parser.add_argument('--compile-conv-encoder', default=0, type=int,
+                            help='wrap the conv encoder forward with torch.compile (requires torch >= 2.0)')
+        parser.add_argument('--conv-encoder-bf16', default=0, type=int,
+                            help='run the multi-kernel conv encoder stack under bf16 autocast (requires torch >= 1.10, '
+                                 'not supported with --fp16)')
+        parser.add_argument('--conv-norm', default='batch', choices=['batch', 'group'],
+                            help='normalization in the conv encoder blocks; group norm needs no '
+                                 'cross-batch statistics and therefore no sync under DDP')
+        parser.add_argument('--conv-channels-last', default=0, type=int,
+                            help='run the multi-kernel convs in channels_last layout (requires torch >= 1.5)')
 
         # joint train with an autoregressive AT on latent codes
         parser.add_argument('--add-at-prior', default=0, type=int,
@@ -512,6 +606,10 @@ class VQVAE(FairseqLanguageModel):
         # use word-prediction as decoder on top of the deconv
         parser.add_argument('--use-word-predict', type=int, default=0)
         parser.add_argument('--disable-mea', type=int, default=0)
+        parser.add_argument('--quantize-bf16-dist', type=int, default=0,
+                            help='compute the code distances for hard (argmin) quantization in bf16')
+        parser.add_argument('--quantize-collect-stats', type=int, default=0,
+                            help='log codebook usage statistics (effective latents) during training')
         parser.add_argument('--code-extract-strategy', type=str, default=None,
                             help=['soft', 'argmax', 'topp'])
 
@@ -591,7 +689,7 @@ class VQVAE(FairseqLanguageModel):
             code_prior = TypedTransformerDecoder(
                 args,
                 None,
-                bottom_quantizer.embed.t(),  # n x emb_dim: nn.Parameter
+                bottom_quantizer.codebook,  # n x emb_dim: nn.Parameter
                 args.decoder_embed_dim, args.decoder_attention_heads,
                 1024, args.decoder_output_dim,
                 args.max_source_positions, 4,
@@ -614,7 +712,8 @@ class VQVAE(FairseqLanguageModel):
             text_encoder = TransformerEncoder(args, src_dict, embed_tokens, args.max_source_positions,
                                               args.encoder_layers, args.encoder_embed_dim, args.encoder_attention_heads,
                                               args.encoder_ffn_embed_dim)
-            text_conv_encoder = ConvEncoder(args.encoder_embed_dim, kernels, strides, args.bottom_latent_dim)
+            text_conv_encoder = ConvEncoder(args.encoder_embed_dim, kernels, strides, args.bottom_latent_dim,
+                                            compile_forward=args.compile_conv_encoder)
         elif args.encoder_form == 'conv':
             if isinstance(kernels[0], int):
                 # kernels are the same
@@ -684,22 +783,23 @@ class VQVAE(FairseqLanguageModel):
         if full_length <= 2:
             return src_tokens
         mask_lengths = (lengths.float() * self.word_drop_rate).long()
-        mask = torch.arange(full_length).to(src_tokens.device).unsqueeze(0).expand(batch, full_length).ge(
-            mask_lengths.unsqueeze(1))
-        mask = mask.long()
-        scores = src_tokens.clone().float().uniform_()
+        max_k = int(mask_lengths.max())
+        if max_k == 0:
+            return src_tokens
+        # drop the mask_lengths highest random scores of each row; topk over max_k avoids a full sort
+        scores = torch.rand(src_tokens.size(), device=src_tokens.device)
         scores.masked_fill_(src_masks, -1)
-        sorted_values, sorted_idx = torch.sort(scores, dim=-1, descending=True)
-        mask = mask.scatter(1, sorted_idx, mask)  # 0 are dropped words
-        src_tokens[(1 - mask).bool()] = self.pad_index
+        _, drop_idx = scores.topk(max_k, dim=-1)  # B x max_k
+        valid = torch.arange(max_k, device=src_tokens.device).unsqueeze(0) < mask_lengths.unsqueeze(1)
+        rows = torch.arange(batch, device=src_tokens.device).unsqueeze(1).expand_as(drop_idx)
+        src_tokens[rows[valid], drop_idx[valid]] = self.pad_index
         return src_tokens
 
     def spacing_mask_words(self, src_tokens, lengths):
         if np.random.uniform() > 0.85:
             return src_tokens
-        valid_lengths = (lengths - 1) / self.shrink_ratio + 1
-        max_length = torch.max(valid_lengths).item()
         max_src_length = src_tokens.size(1)
+        max_length = (max_src_length - 1) // self.shrink_ratio + 1
         valid_index = torch.arange(max_length, device=lengths.device).type_as(lengths).expand(len(lengths), max_length)
         valid_start_idx = valid_index * self.shrink_ratio
         rand1 = torch.randint(1, min(self.shrink_ratio, max_src_length), (src_tokens.size(0),))
@@ -724,8 +824,8 @@ class VQVAE(FairseqLanguageModel):
             return (~((a <= c) | (a >= b))).float()
 
     def create_aug_input(self, src_tokens, lengths):
-        append_lengths = (lengths - 1) / self.shrink_ratio + 1
-        max_length = torch.max(append_lengths).item()
+        append_lengths = (lengths - 1) // self.shrink_ratio + 1
+        max_length = (src_tokens.size(1) - 1) // self.shrink_ratio + 1
         mask = torch.arange(max_length, device=lengths.device).type_as(lengths).expand(len(lengths), max_length)
         mask = mask < append_lengths.unsqueeze(1)  # B x L
         aug_tokens = src_tokens.new_ones((src_tokens.size(0), max_length)).fill_(self.text_encoder.dictionary.bos_index)
@@ -734,7 +834,8 @@ class VQVAE(FairseqLanguageModel):
 
     def forward(self, decoder_tokens, lengths, full_tokens, update_steps, **kwargs):
         mask, diff, quantize_out, quantize_stats, codes = self.forward_encoder(full_tokens, lengths, update_steps,
-                                                                               code_extract_strategy=getattr(self.args, 'code_extract_strategy', None))
+                                                                               code_extract_strategy=getattr(self.args, 'code_extract_strategy', None),
+                                                                               conv_masks=kwargs.get('conv_masks', None))
 
         if self.args.use_word_predict:
             return None, diff, quantize_stats, mask.sum().type_as(diff), codes, quantize_out['word_predict'], None
@@ -760,7 +861,8 @@ class VQVAE(FairseqLanguageModel):
                 logits = decoder_out[0] + deconv_predict_logits
         return logits, diff, quantize_stats, mask.sum().type_as(diff), codes, quantize_out['word_predict'], code_prior
 
-    def forward_encoder(self, full_tokens, lengths, update_steps=-1, extract_code_only=False, code_extract_strategy=None):
+    def forward_encoder(self, full_tokens, lengths, update_steps=-1, extract_code_only=False, code_extract_strategy=None,
+                        conv_masks=None):
         """
                 output of text encoder
                 {
@@ -779,28 +881,29 @@ class VQVAE(FairseqLanguageModel):
             encodings = text_encoder_out['encoder_out']
 
             # encoding_mask = (~text_encoder_out['encoder_padding_mask']).type_as(text_encoder_out['encoder_out'])
-            encoding_mask = (~(full_tokens.eq(self.pad_index) | full_tokens.eq(self.decoder.dictionary.bos()))).type_as(
-                text_encoder_out['encoder_out'])
-            conv_inpt = encodings * (encoding_mask.transpose(0, 1).unsqueeze(-1))  # T x B x C
+            skip_mask = full_tokens.eq(self.pad_index) | full_tokens.eq(self.decoder.dictionary.bos())
+            conv_inpt = encodings.masked_fill(skip_mask.transpose(0, 1).unsqueeze(-1), 0.)  # T x B x C
 
             # !!!!!!!!!!!!! the output mask sets padding to be False
             # text_conv_out: T' x batch x C'
             # mask: batch x T'
             text_conv_out, mask = self.text_conv_encoder(conv_inpt.permute(1, 2, 0),
-                                                         lengths)  # B x C x T -> T' x B x C', C' = latent_dim
+                                                         lengths, conv_masks)  # B x C x T -> T' x B x C', C' = latent_dim
         elif self.encoder_form == 'conv':
             if self.args.use_deconv:
                 if (max_len - 1) % self.shrink_ratio != 0:
                     pad_num = math.ceil((max_len - 1) / self.shrink_ratio) * self.shrink_ratio + 1 - max_len
                     full_tokens = torch.cat([full_tokens, full_tokens.new_full((full_tokens.size(0), pad_num), self.pad_index)], dim=1)
-            text_conv_out, mask = self.text_encoder(full_tokens, lengths, pad_num)
+            # all conv encoders take conv_masks; only FullConvEncoder uses them, the single-kernel and
+            # no-overlap encoders build their masks per block
+            text_conv_out, mask = self.text_encoder(full_tokens, lengths, pad_num, conv_masks=conv_masks)
         elif self.encoder_form == 'no_overlap_conv':
             if self.args.use_deconv:
                 if max_len % self.shrink_ratio != 0:
                     pad_num = self.shrink_ratio - max_len % self.shrink_ratio
                     full_tokens = torch.cat(
                         [full_tokens, full_tokens.new_full((full_tokens.size(0), pad_num), self.pad_index)], dim=1)
-            text_conv_out, mask = self.text_encoder(full_tokens, lengths, pad_num)
+            text_conv_out, mask = self.text_encoder(full_tokens, lengths, pad_num, conv_masks=conv_masks)
         elif self.encoder_form == 'append':
             aug_tokens, mask = self.create_aug_input(full_tokens, lengths)
             text_encoder_out = self.text_encoder(full_tokens, auxilary_tokens=aug_tokens)
@@ -935,6 +1038,16 @@ class VQVAE(FairseqLanguageModel):
             decoder_out = (logits, *decoder_out[1:])
         return decoder_out
 
+    def fuse(self):
+        """Fold BatchNorm into the preceding convs of the conv encoder for inference.
+
+        Call after :func:`load_state_dict` and :func:`eval`; the fused model can no longer be trained.
+        """
+        for module in self.modules():
+            if isinstance(module, (ConvBlock, MultiKernelConvBlock)):
+                module.fuse_bn()
+        return self
+
     def max_positions(self):
         """Maximum length supported by the model."""
         if self.decoder is not None:
@@ -1056,6 +1169,12 @@ def base_architecture(args):
     args.pretrain_steps = getattr(args, 'pretrain_steps', -1)
     args.add_latent_positions = getattr(args, 'add_latent_positions', 0)
     args.context_window = getattr(args, 'context_window', 0)
+    args.compile_conv_encoder = getattr(args, 'compile_conv_encoder', 0)
+    args.conv_channels_last = getattr(args, 'conv_channels_last', 0)
+    args.conv_encoder_bf16 = getattr(args, 'conv_encoder_bf16', 0)
+    args.conv_norm = getattr(args, 'conv_norm', 'batch')
+    args.quantize_bf16_dist = getattr(args, 'quantize_bf16_dist', 0)
+    args.quantize_collect_stats = getattr(args, 'quantize_collect_stats', 0)
 
     args.use_global_quantant = getattr(args, 'use_global_quantant', 0)
     args.global_latent_dim = getattr(args, 'global_latent_dim', args.bottom_latent_dim)
@@ -17,6 +17,7 @@ from fairseq.data import (
     TransformEosDataset,
     TruncatedDictionary,
 )
+from fairseq.models.vqvae_lm import parse_kernel_and_strides
 from fairseq.tasks import register_task
 from fairseq.tasks.language_modeling import LanguageModelingTask
 
@@ -57,6 +58,8 @@ class VQVAELanguageModelingTask(LanguageModelingTask):
                             help='if true, use several consecutive sentences (window_size*2+1) as pretrain input')
         parser.add_argument('--context-mode', type=str, default='window', choices=['doc', 'window'])
         parser.add_argument('--window-size', type=int, default=3)
+        parser.add_argument('--precompute-conv-masks', type=int, default=0,
+                            help='if true, build the conv encoder padding masks in the data loader')
         # fmt: on
 
     def extract_codes(self, sample, model):
@@ -154,6 +157,19 @@ class VQVAELanguageModelingTask(LanguageModelingTask):
             and self.args.sample_break_mode != "none"
         )
 
+        conv_strides = None
+        if getattr(self.args, 'precompute_conv_masks', 0):
+            kernels, conv_strides = parse_kernel_and_strides(self.args.bottom_conv_kernel_size,
+                                                             self.args.bottom_conv_stride)
+            encoder_form = getattr(self.args, 'encoder_form', 'mix')
+            # only ConvEncoder (mix) and the multi-kernel FullConvEncoder (conv) consume precomputed masks
+            if encoder_form not in ('mix', 'conv') or (encoder_form == 'conv' and isinstance(kernels[0], int)):
+                raise ValueError('--precompute-conv-masks is only supported with --encoder-form mix or with '
+                                 '--encoder-form conv and multi-kernel --bottom-conv-kernel-size')
+            if encoder_form == 'conv' and getattr(self.args, 'use_deconv', 0):
+                print('| WARNING: with --use-deconv, batches padded to a multiple of the total conv stride '
+                      'rebuild their conv masks in the encoder')
+
         self.datasets[split] = MonolingualDataset(
             dataset,
             dataset.sizes,
@@ -163,6 +179,7 @@ class VQVAELanguageModelingTask(LanguageModelingTask):
             shuffle=True,
             targets=self.targets,
             add_bos_token=self.args.add_bos_token,
+            conv_strides=conv_strides,
         )
 
     def build_dataset_for_inference(self, src_tokens, src_lengths):
@@ -185,12 +185,17 @@ def strip_pad(tensor, pad):
     return tensor[tensor.ne(pad)]
 
 
-def buffered_arange(max):
-    if not hasattr(buffered_arange, 'buf'):
-        buffered_arange.buf = torch.LongTensor()
-    if max > buffered_arange.buf.numel():
-        torch.arange(max, out=buffered_arange.buf)
-    return buffered_arange.buf[:max]
+def buffered_arange(max, device=None):
+    # one buffer per device, so callers on the GPU do not copy a CPU arange every call
+    if not hasattr(buffered_arange, 'bufs'):
+        buffered_arange.bufs = {}
+    device = torch.device('cpu') if device is None else torch.device(device)
+    if device not in buffered_arange.bufs:
+        buffered_arange.bufs[device] = torch.empty(0, dtype=torch.long, device=device)
+    buf = buffered_arange.bufs[device]
+    if max > buf.numel():
+        torch.arange(max, out=buf)
+    return buf[:max]
 
 
 def convert_padding_direction(src_tokens, padding_idx, right_to_left=False, left_to_right=False):
@@ -0,0 +1,278 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import copy
+import pickle
+import unittest
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from fairseq.data import Dictionary
+from fairseq.data.monolingual_dataset import collate
+from fairseq.models.conv_encoder import (
+    ConvBlock, ConvEncoder, FullConvEncoder, MultiKernelConvBlock, compute_conv_mask, conv_encoder_forward,
+    conv_relu_mask,
+)
+
+
+def per_kernel_conv(x, convs, kernels):
+    # the original one-conv-per-kernel path that merged_conv replaces
+    outs = [conv(x if k % 2 != 0 else F.pad(x, (k // 2, k // 2 - 1), 'constant', 0))
+            for conv, k in zip(convs, kernels)]
+    return torch.cat(outs, dim=1)
+
+
+def per_kernel_forward(block, x, lengths):
+    new_length, new_mask = compute_conv_mask(lengths, block.stride, x.size(-1))
+    residual = block.downsample(x)
+    mask = new_mask.type_as(residual).unsqueeze(1)
+    out = F.relu(block.bn1(per_kernel_conv(x, block.conv_block_1, block.kernels))) * mask
+    out = block.bn2(per_kernel_conv(out, block.conv_block_2, block.kernels))
+    out = F.relu(out + residual) * mask
+    return out, new_length, new_mask
+
+
+class TestMultiKernelConvBlock(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.kernels = [2, 3, 4, 5]
+        self.lengths = torch.LongTensor([11, 7, 4])
+        x = torch.randn(3, 8, 11)
+        pad = torch.arange(11).unsqueeze(0) >= self.lengths.unsqueeze(1)
+        self.x = x.masked_fill(pad.unsqueeze(1), 0.)
+
+    def _block(self, stride, **kwargs):
+        block = MultiKernelConvBlock(8, self.kernels, stride, 4, **kwargs)
+        block.eval()
+        return block
+
+    def test_merged_conv_matches_per_kernel(self):
+        for stride in (1, 2, 3):
+            block = self._block(stride)
+            with torch.no_grad():
+                expected = per_kernel_conv(self.x, block.conv_block_1, self.kernels)
+                self.assertTrue(torch.allclose(block.merged_conv(self.x, 'conv_block_1', stride),
+                                               expected, atol=1e-5))
+
+    def test_forward_matches_per_kernel(self):
+        for stride in (1, 2):
+            block = self._block(stride)
+            with torch.no_grad():
+                out, length, mask = block(self.x, self.lengths)
+                expected, expected_length, expected_mask = per_kernel_forward(block, self.x, self.lengths)
+            self.assertTrue(torch.equal(length, expected_length))
+            self.assertTrue(torch.equal(mask, expected_mask))
+            self.assertTrue(torch.allclose(out, expected, atol=1e-5))
+
+    def test_packed_weight_cache_per_stage(self):
+        block = self._block(2)
+        with torch.no_grad():
+            block(self.x, self.lengths)
+            self.assertIsNotNone(block._packed_conv_block_1)
+            self.assertIsNotNone(block._packed_conv_block_2)
+
+            # a copy replaces its single entry per stage instead of adding one
+            clone = copy.deepcopy(block)
+            clone.conv_block_1[0].weight.add_(1.)
+            out, _, _ = clone(self.x, self.lengths)
+            expected, _, _ = per_kernel_forward(clone, self.x, self.lengths)
+            self.assertTrue(torch.allclose(out, expected, atol=1e-5))
+            self.assertEqual(clone._packed_conv_block_1[1].data_ptr(),
+                             clone.packed_weight('conv_block_1')[0].data_ptr())
+
+        # moving the module drops the packed copies
+        block.double()
+        self.assertIsNone(block._packed_conv_block_1)
+        self.assertIsNone(block._packed_conv_block_2)
+
+    def test_channels_last_matches_per_kernel(self):
+        block = self._block(2, channels_last=True)
+        with torch.no_grad():
+            out, _, _ = block(self.x, self.lengths)
+            expected, _, _ = per_kernel_forward(block, self.x, self.lengths)
+        self.assertTrue(torch.allclose(out, expected, atol=1e-5))
+
+
+class TestFuseBatchNorm(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.lengths = torch.LongTensor([11, 7, 4])
+        self.x = torch.randn(3, 8, 11)
+
+    def _train(self, block, run, steps=5):
+        # move the BatchNorm running statistics and affine parameters away from their defaults
+        block.train()
+        optimizer = torch.optim.SGD(block.parameters(), lr=0.1)
+        for _ in range(steps):
+            optimizer.zero_grad()
+            run(block, torch.randn_like(self.x) * 2 + 1).pow(2).mean().backward()
+            optimizer.step()
+        block.eval()
+
+    def _check_fused(self, block, run):
+        self._train(block, run)
+        with torch.no_grad():
+            expected = run(block, self.x)
+            block.fuse_bn()
+            self.assertTrue(torch.allclose(run(block, self.x), expected, atol=1e-5))
+
+    def test_multi_kernel_block(self):
+        for stride in (1, 2):
+            block = MultiKernelConvBlock(8, [2, 3, 4, 5], stride, 4)
+            self._check_fused(block, lambda b, x: b(x, self.lengths)[0])
+
+    def test_conv_block(self):
+        for use_stride_first in (True, False):
+            block = ConvBlock(8, 3, 2, use_stride_first=use_stride_first)
+            self._check_fused(block, lambda b, x: b(x, self.lengths, x.size(-1))[0])
+
+
+class TestPrecomputedConvMasks(unittest.TestCase):
+
+    def test_collate_matches_compute_conv_mask(self):
+        samples = [
+            {'id': i, 'source': torch.LongTensor([4] * n + [2]), 'target': None}
+            for i, n in enumerate([12, 5, 8, 1])
+        ]
+        strides = [2, 3, 1, 2]
+        batch = collate(samples, pad_idx=1, eos_idx=2, conv_strides=strides)
+
+        lengths = batch['net_input']['src_lengths']
+        max_length = batch['net_input']['src_tokens'].size(1)
+        self.assertEqual(len(batch['conv_masks']), len(strides))
+        for stride, conv_mask in zip(strides, batch['conv_masks']):
+            lengths, mask = compute_conv_mask(lengths, stride, max_length)
+            max_length = mask.size(1)
+            self.assertTrue(torch.equal(conv_mask, mask))
+
+
+class TestConvEncoderCopies(unittest.TestCase):
+
+    def test_copies_run_their_own_convs(self):
+        torch.manual_seed(0)
+        encoder = ConvEncoder(8, [3, 5], [2, 1], 4, compile_forward=True)
+        clone = copy.deepcopy(encoder)
+        pickle.loads(pickle.dumps(encoder))
+        # run both eagerly, the dispatch on self is the same as for the compiled function
+        encoder.compile_forward = clone.compile_forward = False
+        with torch.no_grad():
+            clone.quant_conv.weight.zero_()
+            x, lengths = torch.randn(2, 8, 9), torch.LongTensor([9, 6])
+            out, _ = clone(x, lengths)
+            expected = clone.quant_conv.bias.view(1, 1, -1).expand_as(out)
+            self.assertTrue(torch.allclose(out, expected))
+            self.assertFalse(torch.allclose(encoder(x, lengths)[0], out))
+
+
+class TestScriptedConvEncoder(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.encoder = ConvEncoder(8, [3, 5, 3], [2, 1, 2], 4).eval()
+        self.lengths = torch.LongTensor([11, 6, 2])
+        tokens = torch.randint(0, 20, (3, 11))
+        embed = F.dropout(nn.Embedding(20, 8)(tokens), p=0.1, training=False)
+        pad = torch.arange(11).unsqueeze(0) >= self.lengths.unsqueeze(1)
+        self.x = embed.masked_fill(pad.unsqueeze(-1), 0.).transpose(1, 2)
+
+    def _masks(self):
+        masks, lengths, max_length = [], self.lengths, self.x.size(-1)
+        for s in self.encoder.strides:
+            lengths, mask = compute_conv_mask(lengths, s, max_length)
+            max_length = mask.size(1)
+            masks.append(mask)
+        return masks
+
+    def _eager(self, masks):
+        x = self.x
+        for conv, mask in zip(self.encoder.conv_blocks, masks):
+            x = F.relu(conv(x)).masked_fill(~mask.unsqueeze(1), 0.)
+        return self.encoder.quant_conv(x).permute(2, 0, 1)
+
+    def test_matches_eager(self):
+        masks = self._masks()
+        with torch.no_grad():
+            expected = self._eager(masks)
+            for conv_masks in (None, masks):
+                out, mask = self.encoder(self.x, self.lengths, conv_masks=conv_masks)
+                torch.testing.assert_close(out, expected)
+                self.assertTrue(torch.equal(mask, masks[-1]))
+            # the function --compile-conv-encoder compiles
+            torch.testing.assert_close(conv_encoder_forward(self.encoder, self.x, masks)[0], expected)
+
+    def test_conv_relu_mask(self):
+        masks = self._masks()
+        convs = self.encoder.conv_blocks
+        with torch.no_grad():
+            out = conv_relu_mask(self.x, [c.weight for c in convs], [c.bias for c in convs],
+                                 list(self.encoder.strides), [c.padding[0] for c in convs], masks)
+            x = self.x
+            for conv, mask in zip(convs, masks):
+                x = F.relu(conv(x)).masked_fill(~mask.unsqueeze(1), 0.)
+        torch.testing.assert_close(out, x)
+
+
+def build_full_conv_encoder(**kwargs):
+    args = argparse.Namespace(encoder_learned_pos=False, dropout=0.1, conv_encoder_bf16=0, fp16=False)
+    for k, v in kwargs.items():
+        setattr(args, k, v)
+    dictionary = Dictionary()
+    for i in range(10):
+        dictionary.add_symbol('w{}'.format(i))
+    embed_tokens = nn.Embedding(len(dictionary), 16, padding_idx=dictionary.pad())
+    return FullConvEncoder(args, 16, [[2, 3], [3]], [2, 1], 8, embed_tokens, dictionary), dictionary
+
+
+class TestFullConvEncoderBF16(unittest.TestCase):
+
+    def test_bf16_rejected_with_fp16(self):
+        with self.assertRaises(ValueError):
+            build_full_conv_encoder(conv_encoder_bf16=1, fp16=True)
+        build_full_conv_encoder(conv_encoder_bf16=1, fp16=False)
+
+    @unittest.skipUnless(torch.cuda.is_available(), 'bf16 conv stack only runs on CUDA')
+    def test_bf16_keeps_model_dtype(self):
+        torch.manual_seed(0)
+        encoder, dictionary = build_full_conv_encoder(conv_encoder_bf16=1)
+        encoder = encoder.cuda().eval()
+        tokens = torch.randint(dictionary.nspecial, len(dictionary), (2, 9)).cuda()
+        out, _ = encoder(tokens, torch.LongTensor([9, 9]).cuda())
+        self.assertEqual(out.dtype, torch.float)
+
+
+class TestFusedEmbedding(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.encoder, dictionary = build_full_conv_encoder(dropout=0.3)
+        self.tokens = torch.randint(dictionary.nspecial, len(dictionary), (3, 7))
+        self.tokens[:, 0] = dictionary.bos()
+        self.tokens[1, 5:] = dictionary.pad()
+        self.encoding_mask = self.tokens.ne(dictionary.pad()) & self.tokens.ne(dictionary.bos())
+
+    def _eager(self, training):
+        encoder = self.encoder
+        x = encoder.embed_scale * encoder.embed_tokens(self.tokens) + encoder.embed_positions(self.tokens)
+        x = x * self.encoding_mask.unsqueeze(-1).float()
+        return F.dropout(x, p=encoder.dropout, training=training)
+
+    def test_matches_eager(self):
+        for training in (False, True):
+            self.encoder.train(training)
+            with torch.no_grad():
+                torch.manual_seed(1)
+                x, embed = self.encoder.forward_embedding(self.tokens, self.encoding_mask)
+                torch.manual_seed(1)
+                expected = self._eager(training)
+            torch.testing.assert_close(x, expected)
+            torch.testing.assert_close(embed, self.encoder.embed_tokens(self.tokens))
+
+
+if __name__ == '__main__':
+    unittest.main()
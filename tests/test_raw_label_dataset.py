@@ -0,0 +1,84 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+
+import numpy as np
+import torch
+from fairseq.data import RawLabelDataset
+
+
+class TestRawLabelDataset(unittest.TestCase):
+
+    def _collate(self, labels, pad_idx=0):
+        dataset = RawLabelDataset(labels, pad_idx=pad_idx)
+        return dataset.collater([dataset[i] for i in range(len(dataset))])
+
+    def test_equal_length_int(self):
+        out = self._collate([[1, 2, 3], [4, 5, 6]])
+        self.assertEqual(out.dtype, torch.long)
+        self.assertTrue(torch.equal(out, torch.tensor([[1, 2, 3], [4, 5, 6]])))
+
+    def test_equal_length_float(self):
+        out = self._collate([[0.5, 1.5], [2.5, 3.5]])
+        self.assertTrue(out.is_floating_point())
+        self.assertTrue(torch.equal(out, torch.tensor([[0.5, 1.5], [2.5, 3.5]])))
+
+    def test_mixed_int_float(self):
+        for labels in ([[1, 2.5], [3, 4]], [[1, 2], [3, 4.5, 5]]):
+            out = self._collate(labels)
+            self.assertEqual(out.dtype, torch.float)
+        self.assertTrue(torch.equal(self._collate([[1, 2.5], [3, 4]]), torch.tensor([[1., 2.5], [3., 4.]])))
+        self.assertTrue(torch.equal(self._collate([[1, 2], [3, 4.5, 5]]),
+                                    torch.tensor([[1., 2., 0.], [3., 4.5, 5.]])))
+
+    def test_nested_equal_shape(self):
+        labels = [[[1, 2], [3, 4]], [[5, 6], [7, 8]]]
+        out = self._collate(labels)
+        self.assertTrue(torch.equal(out, torch.tensor(labels)))
+
+    def test_empty_row_keeps_int(self):
+        out = self._collate([[], [1, 2]])
+        self.assertEqual(out.dtype, torch.long)
+        self.assertTrue(torch.equal(out, torch.tensor([[0, 0], [1, 2]])))
+
+    def test_ragged_int(self):
+        out = self._collate([[1, 2, 3], [4]], pad_idx=-1)
+        self.assertEqual(out.dtype, torch.long)
+        self.assertTrue(torch.equal(out, torch.tensor([[1, 2, 3], [4, -1, -1]])))
+
+    def test_ragged_float(self):
+        out = self._collate([[0.5], [1.5, 2.5]])
+        self.assertTrue(out.is_floating_point())
+        self.assertTrue(torch.equal(out, torch.tensor([[0.5, 0.0], [1.5, 2.5]])))
+
+    def test_ragged_float_keeps_values(self):
+        out = self._collate([[0.25, 1.75, 2.5], [3.125]], pad_idx=-1)
+        self.assertEqual(out.dtype, torch.float)
+        self.assertTrue(torch.equal(out, torch.tensor([[0.25, 1.75, 2.5], [3.125, -1.0, -1.0]])))
+
+    def test_ragged_int_large_values(self):
+        out = self._collate([[2 ** 40], [7, 8]], pad_idx=1)
+        self.assertEqual(out.dtype, torch.long)
+        self.assertTrue(torch.equal(out, torch.tensor([[2 ** 40, 1], [7, 8]])))
+
+    def test_ragged_ndarray(self):
+        labels = [np.array([1, 2], dtype=np.int32), np.array([3], dtype=np.int32)]
+        out = self._collate(labels)
+        self.assertEqual(out.dtype, torch.int32)
+        self.assertTrue(torch.equal(out, torch.tensor([[1, 2], [3, 0]], dtype=torch.int32)))
+
+    def test_equal_length_tensor(self):
+        labels = [torch.LongTensor([1, 2]), torch.LongTensor([3, 4])]
+        self.assertTrue(torch.equal(self._collate(labels), torch.stack(labels)))
+
+    def test_ragged_tensor(self):
+        labels = [torch.FloatTensor([0.5, 1.5, 2.5]), torch.FloatTensor([3.5])]
+        out = self._collate(labels, pad_idx=1)
+        self.assertTrue(torch.equal(out, torch.FloatTensor([[0.5, 1.5, 2.5], [3.5, 1.0, 1.0]])))
+
+
+if __name__ == '__main__':
+    unittest.main()
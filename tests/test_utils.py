@@ -74,6 +74,16 @@ class TestUtils(unittest.TestCase):
             utils.make_positions(right_pad_input, pad),
         )
 
+    def test_buffered_arange(self):
+        self.assertTrue(torch.equal(utils.buffered_arange(5), torch.arange(5)))
+        self.assertTrue(torch.equal(utils.buffered_arange(9, torch.device('cpu')), torch.arange(9)))
+        # shorter requests are served from the grown buffer
+        self.assertTrue(torch.equal(utils.buffered_arange(3), torch.arange(3)))
+        if torch.cuda.is_available():
+            out = utils.buffered_arange(7, torch.device('cuda'))
+            self.assertTrue(out.is_cuda)
+            self.assertTrue(torch.equal(out.cpu(), torch.arange(7)))
+
     def assertAlmostEqual(self, t1, t2):
         self.assertEqual(t1.size(), t2.size(), "size mismatch")
         self.assertLess(utils.item((t1 - t2).abs().max()), 1e-4)
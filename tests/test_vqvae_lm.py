@@ -0,0 +1,55 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import unittest
+
+import torch
+from fairseq.data import Dictionary
+from fairseq.models.vqvae_lm import VQVAE
+
+
+class TestMaskWords(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.dictionary = Dictionary()
+        for i in range(20):
+            self.dictionary.add_symbol('w{}'.format(i))
+        # mask_words only reads these attributes of the model
+        self.model = argparse.Namespace(
+            pad_index=self.dictionary.pad(),
+            decoder=argparse.Namespace(dictionary=self.dictionary),
+        )
+
+    def _batch(self, lengths):
+        # bos + words, right padded; lengths count the bos
+        tokens = torch.full((len(lengths), max(lengths)), self.dictionary.pad(), dtype=torch.long)
+        for i, n in enumerate(lengths):
+            tokens[i, 0] = self.dictionary.bos()
+            tokens[i, 1:n] = torch.randint(self.dictionary.nspecial, len(self.dictionary), (n - 1,))
+        return tokens, torch.LongTensor(lengths)
+
+    def test_drop_counts_and_specials(self):
+        for p in (0.1, 0.3, 0.5):
+            self.model.word_drop_rate = p
+            for _ in range(10):
+                tokens, lengths = self._batch([12, 7, 3, 9, 1])
+                specials = tokens.eq(self.dictionary.pad()) | tokens.eq(self.dictionary.bos())
+                out = VQVAE.mask_words(self.model, tokens.clone(), lengths)
+
+                self.assertTrue(torch.equal(out[specials], tokens[specials]))
+                dropped = out.ne(tokens)
+                self.assertTrue(out[dropped].eq(self.dictionary.pad()).all())
+                self.assertTrue(torch.equal(dropped.sum(1), (lengths.float() * p).floor().long()))
+
+    def test_no_drop(self):
+        self.model.word_drop_rate = 0.
+        tokens, lengths = self._batch([6, 4])
+        self.assertTrue(torch.equal(VQVAE.mask_words(self.model, tokens.clone(), lengths), tokens))
+
+
+if __name__ == '__main__':
+    unittest.main()
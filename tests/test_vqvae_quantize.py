@@ -0,0 +1,170 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import unittest
+
+import torch
+import torch.nn.functional as F
+from fairseq.models.vqvae_lm import Quantize
+
+
+def quantize_args(**kwargs):
+    args = argparse.Namespace(
+        soft_em=0,
+        soft_max_temp=1.0,
+        soft_min_temp=1.0,
+        soft_temp_anneal_steps=0,
+        soft_samples=1,
+        quantize_explore_steps=-1,
+        commitment_cost=0.25,
+        disable_mea=0,
+    )
+    for k, v in kwargs.items():
+        setattr(args, k, v)
+    return args
+
+
+def v1_state_dict(dim, n_embed):
+    # a Quantize state dict from before the K x C codebook layout
+    embed = torch.randn(dim, n_embed)
+    return {
+        'embed': embed,
+        'cluster_size': torch.rand(n_embed),
+        'embed_avg': embed * 2,
+    }
+
+
+class TestQuantizeCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.dim, self.n_embed = 4, 6
+
+    def _load(self, quantizer, state_dict):
+        quantizer.upgrade_state_dict_named(state_dict, '')
+        quantizer.load_state_dict(state_dict, strict=True)
+
+    def test_load_v1_ema_codebook(self):
+        old = v1_state_dict(self.dim, self.n_embed)
+        quantizer = Quantize(quantize_args(), self.dim, self.n_embed)
+        self._load(quantizer, dict(old))
+
+        self.assertTrue(torch.equal(quantizer.embed, old['embed'].t()))
+        self.assertTrue(torch.equal(quantizer.embed_avg, old['embed_avg'].t()))
+        self.assertTrue(torch.allclose(quantizer.embed_sqnorm, old['embed'].pow(2).sum(0)))
+
+        quantizer.eval()
+        x = torch.randn(3, 2, self.dim)
+        mask = torch.tensor([[1, 1], [1, 1], [1, 0]])
+        quantize, _, embed_ind, _ = quantizer(x, mask)
+
+        # the C x K computation the quantizer used before the layout change
+        dist = (
+            x.reshape(-1, self.dim).pow(2).sum(1, keepdim=True)
+            - 2 * x.reshape(-1, self.dim) @ old['embed']
+            + old['embed'].pow(2).sum(0, keepdim=True)
+        )
+        _, expected_ind = dist.min(1)
+        expected = old['embed'].t()[expected_ind].view(3, 2, self.dim) * mask.unsqueeze(-1).float()
+        self.assertTrue(torch.equal(embed_ind, expected_ind))
+        self.assertTrue(torch.allclose(quantize, expected))
+
+    def test_load_v1_learned_codebook(self):
+        old = v1_state_dict(self.dim, self.n_embed)
+        quantizer = Quantize(quantize_args(disable_mea=1), self.dim, self.n_embed)
+        self._load(quantizer, dict(old))
+        # learned codebooks keep the C x K layout
+        self.assertTrue(torch.equal(quantizer.embed.data, old['embed']))
+        self.assertTrue(torch.equal(quantizer.codebook, old['embed'].t()))
+
+    def test_load_ema_into_learned_codebook(self):
+        ema = Quantize(quantize_args(), self.dim, self.n_embed)
+        learned = Quantize(quantize_args(disable_mea=1), self.dim, self.n_embed)
+        self._load(learned, dict(ema.state_dict()))
+        self.assertTrue(torch.equal(learned.codebook, ema.codebook))
+
+
+def onehot_ema_step(quantizer, cluster_size, embed_avg, flatten, embed_ind, mask1d):
+    # the S x K one-hot EMA update that bincount / index_add_ replace, in the K x C layout
+    onehot = F.one_hot(embed_ind, quantizer.n_embed).type_as(flatten)[mask1d]  # num_latents x K
+    cluster_size = cluster_size * quantizer.decay + (1 - quantizer.decay) * onehot.sum(0)
+    embed_avg = embed_avg * quantizer.decay + (1 - quantizer.decay) * (onehot.t() @ flatten[mask1d])
+    n = cluster_size.sum()
+    smoothed = (cluster_size + quantizer.eps) / (n + quantizer.n_embed * quantizer.eps) * n
+    return cluster_size, embed_avg, embed_avg / smoothed.unsqueeze(1)
+
+
+class TestQuantizeEMA(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.dim, self.n_embed = 4, 6
+        self.x = torch.randn(5, 3, self.dim)
+        # the last sequence is padded after two steps
+        self.mask = torch.ones(5, 3, dtype=torch.bool)
+        self.mask[2:, 2] = False
+
+    def test_ema_step_matches_onehot(self):
+        quantizer = Quantize(quantize_args(), self.dim, self.n_embed)
+        quantizer.train()
+        cluster_size, embed_avg = quantizer.cluster_size.clone(), quantizer.embed_avg.clone()
+        _, _, embed_ind, _ = quantizer(self.x, self.mask)
+
+        expected_cluster_size, expected_embed_avg, expected_embed = onehot_ema_step(
+            quantizer, cluster_size, embed_avg, self.x.reshape(-1, self.dim), embed_ind, self.mask.view(-1))
+        torch.testing.assert_close(quantizer.cluster_size, expected_cluster_size)
+        torch.testing.assert_close(quantizer.embed_avg, expected_embed_avg)
+        torch.testing.assert_close(quantizer.embed, expected_embed)
+
+    def test_embed_sqnorm_follows_ema_updates(self):
+        quantizer = Quantize(quantize_args(), self.dim, self.n_embed)
+        quantizer.train()
+        for _ in range(5):
+            quantizer(torch.randn(5, 3, self.dim) * 2 + 1, self.mask)
+            torch.testing.assert_close(quantizer.embed_sqnorm, quantizer.codebook.pow(2).sum(1))
+
+        # a trained checkpoint reloads with the buffer rebuilt from its codebook
+        state_dict = quantizer.state_dict()
+        state_dict['embed_sqnorm'] = torch.zeros(self.n_embed)
+        reloaded = Quantize(quantize_args(), self.dim, self.n_embed)
+        reloaded.upgrade_state_dict_named(state_dict, '')
+        reloaded.load_state_dict(state_dict, strict=True)
+        torch.testing.assert_close(reloaded.embed_sqnorm, quantizer.codebook.pow(2).sum(1))
+
+
+class TestQuantizeCommitmentLoss(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.dim, self.n_embed = 4, 6
+        self.quantizer = Quantize(quantize_args(), self.dim, self.n_embed)
+        self.quantizer.eval()
+
+    def _expected(self, x, mask, embed_ind):
+        q = self.quantizer.codebook[embed_ind].view_as(x)
+        m = mask.unsqueeze(-1).float()
+        return ((q - x) ** 2 * m).sum() / (m.sum() * self.dim)
+
+    def test_masked_mean(self):
+        x = torch.randn(5, 3, self.dim)
+        mask = torch.ones(5, 3, dtype=torch.bool)
+        mask[3:, 0] = False
+        mask[:, 1] = False  # a sequence that is padding only
+        _, diff, embed_ind, _ = self.quantizer(x, mask)
+        torch.testing.assert_close(diff, self._expected(x, mask, embed_ind))
+
+        # padded positions must not contribute, whatever their values
+        _, padded_diff, _, _ = self.quantizer(x.masked_fill(~mask.unsqueeze(-1), 100.), mask)
+        torch.testing.assert_close(padded_diff, diff)
+
+    def test_all_padding(self):
+        x = torch.randn(5, 3, self.dim)
+        _, diff, _, _ = self.quantizer(x, torch.zeros(5, 3, dtype=torch.bool))
+        self.assertEqual(diff.item(), 0.)
+
+
+if __name__ == '__main__':
+    unittest.main()